@@ -1,7 +1,7 @@
 # Define complex grammar rules
 import time
 
-from llm_grammar import LLMGrammar, Terminal, Rule, Choice, Repeat, Optional
+from llm_grammar import LLMGrammar, Terminal, NonTerminal, Rule, Choice, Repeat, Optional
 
 
 class TestGrammar(LLMGrammar):
@@ -82,4 +82,80 @@ def run_tests():
 
 
 # Run the tests
-run_tests()
\ No newline at end of file
+run_tests()
+
+
+# Draft verification for speculative decoding
+draft_vocab = ['ab', '@', 'x', '.com', '1', '', '</s>']
+draft_eos_token_id = 6
+
+
+def draft_decode(token_ids):
+    return ''.join('' if token_id == draft_eos_token_id else draft_vocab[token_id] for token_id in token_ids)
+
+
+def create_email_grammar():
+    email_grammar = LLMGrammar()
+    email = Terminal(r'[a-z]+@[a-z]+\.com', 'email', regex_terminal=True)
+    email_grammar.add_rule(NonTerminal([email], 'main'))
+    return email_grammar
+
+
+def create_digits_grammar():
+    digits_grammar = LLMGrammar()
+    digits_grammar.add_rule(Repeat(Terminal(r'\d', 'digit', regex_terminal=True), 'main', min_repeats=1))
+    return digits_grammar
+
+
+def allowed(mask):
+    return [token_id for token_id, is_allowed in enumerate(mask) if is_allowed]
+
+
+def verify_draft(draft_grammar, prefix, draft, candidates=None, max_consider=None):
+    vocab_size = len(draft_vocab)
+    if candidates is None:
+        candidates = range(vocab_size)
+    accepted = draft_grammar.longest_valid_draft_prefix(prefix, draft, draft_decode, vocab_size,
+                                                        draft_eos_token_id, 'main')
+    masks_accepted, masks = draft_grammar.draft_allowed_masks(prefix, draft, draft_decode, vocab_size,
+                                                              draft_eos_token_id, 'main', candidates, max_consider)
+    assert accepted == masks_accepted, (accepted, masks_accepted)
+    return accepted, [allowed(mask) for mask in masks]
+
+
+def run_draft_tests():
+    # A rejected token in the middle of the draft
+    assert verify_draft(create_email_grammar(), '', [0, 1, 4, 2]) == (2, [[0, 2], [0, 1, 2], [0, 2]])
+
+    # Full acceptance with the bonus mask
+    assert verify_draft(create_email_grammar(), '', [0, 1, 2]) == (3, [[0, 2], [0, 1, 2], [0, 2], [0, 2, 3]])
+
+    # Completion allows EOS, and acceptance stops after it
+    accepted, masks = verify_draft(create_email_grammar(), '', [0, 1, 2, 3, draft_eos_token_id])
+    assert accepted == 5 and len(masks) == 5 and masks[4] == [draft_eos_token_id]
+    assert verify_draft(create_email_grammar(), '', [0, 1, 2, 3, 2])[0] == 4
+    assert verify_draft(create_email_grammar(), 'ab', [draft_eos_token_id]) == (0, [[0, 1, 2]])
+
+    # A complete string that the grammar can still extend
+    assert verify_draft(create_digits_grammar(), '', [4, 4, 4]) == (3, [[4], [4, 6], [4, 6], [4, 6]])
+    assert verify_draft(create_digits_grammar(), '1', [draft_eos_token_id, 4]) == (1, [[4, 6]])
+
+    # Candidates only fill the mask, the draft token itself is always checked
+    accepted, masks = verify_draft(create_email_grammar(), '', [0, 1], candidates={2, 4})
+    assert accepted == 2 and masks == [[0, 2], [1, 2], [2]]
+    assert verify_draft(create_email_grammar(), 'ab@', [], candidates=[4, 0, 2], max_consider=1) == (
+        0, [[draft_eos_token_id]])
+    email_grammar = create_email_grammar()
+    accepted, masks = email_grammar.draft_allowed_masks('', (token_id for token_id in [0, 1]), draft_decode,
+                                                        len(draft_vocab), draft_eos_token_id, 'main', iter([2]))
+    assert accepted == 2 and len(masks) == 3
+
+    # Use after parse() on the same instance, as the logits processors call it
+    email_grammar = create_email_grammar()
+    email_grammar.parse('ab', 'main')
+    email_grammar.parse('ab@', 'main')
+    assert verify_draft(email_grammar, 'ab', [1]) == (1, [[0, 1, 2], [0, 2]])
+    print("Draft verification tests passed")
+
+
+run_draft_tests()
@@ -1,26 +1,20 @@
 import regex
 from functools import lru_cache
+from itertools import islice
 
 
 class LLMGrammar:
     def __init__(self):
         self.rules = {}
-        self.memo = {}
         self.verbose = False
-        self.last_checked_string = ""
-        self.last_checked_rule_name = ""
 
     def add_rule(self, rule):
         self.rules[rule.element_name] = rule
 
     def parse(self, string, rule_name, verbose=False):
-        if (not string.startswith(self.last_checked_string)) or rule_name != self.last_checked_rule_name:
-            self.memo = {}
         self.verbose = verbose
         success, end_position, parsed_elements, error, matched_only_partially = self.parse_rule(self.rules[rule_name],
                                                                                                 string, 0)
-        self.last_checked_string = string
-        self.last_checked_rule_name = rule_name
         if verbose:
             if success and end_position == len(string) and error is None:
                 return True, matched_only_partially, parsed_elements
@@ -32,18 +26,107 @@ class LLMGrammar:
             else:
                 return False, False
 
+    def longest_valid_draft_prefix(self, prefix, draft_token_ids, decode, vocab_size, eos_token_id, rule_name):
+        """Return how many leading draft tokens keep prefix + decoded draft valid under rule_name.
+
+        Tokens are decoded one at a time, like the logits processors do. A token is rejected if it is out of
+        range, decodes to an empty string (the processors never bias those) or breaks the grammar.
+        eos_token_id is accepted once the string fully matches the grammar, and acceptance stops after it.
+        """
+        string = prefix
+        complete = self._is_complete(prefix, rule_name)
+        pieces = {}
+        accepted = 0
+        for token_id in draft_token_ids:
+            token_id = int(token_id)
+            if token_id == eos_token_id:
+                if complete:
+                    accepted += 1
+                break
+            valid, string, complete = self._extend_draft(string, token_id, decode, vocab_size, rule_name, pieces)
+            if not valid:
+                break
+            accepted += 1
+        return accepted
+
+    def draft_allowed_masks(self, prefix, draft_token_ids, decode, vocab_size, eos_token_id, rule_name,
+                            candidate_token_ids, max_consider=None):
+        """Return the accepted draft length and one allowed-token mask (list of bools) per verified position.
+
+        masks[i] is the mask for the token following prefix + draft_token_ids[:i]. There is one mask for every
+        accepted token and one for the position after it: the rejected token, or the bonus token if the whole
+        draft is accepted. No mask follows an accepted eos_token_id.
+
+        Each mask allows the draft token at that position if it is valid, plus the valid tokens among the
+        first max_consider candidate_token_ids (e.g. the target model's top-k). eos_token_id is allowed once
+        the string fully matches the grammar, and also when nothing else is allowed, so a mask is never all
+        False. Apart from that fallback the accepted length equals longest_valid_draft_prefix.
+        """
+        draft_token_ids = [int(token_id) for token_id in draft_token_ids]
+        candidate_token_ids = [int(token_id) for token_id in islice(candidate_token_ids, max_consider)]
+        pieces = {}
+        masks = []
+        string = prefix
+        complete = self._is_complete(prefix, rule_name)
+        accepted = 0
+        for position in range(len(draft_token_ids) + 1):
+            draft_token_id = draft_token_ids[position] if position < len(draft_token_ids) else None
+            mask = [False] * vocab_size
+            extensions = {}
+            for token_id in candidate_token_ids + ([draft_token_id] if draft_token_id is not None else []):
+                if token_id == eos_token_id or token_id in extensions:
+                    continue
+                valid, extended, extended_complete = self._extend_draft(string, token_id, decode, vocab_size,
+                                                                        rule_name, pieces)
+                if valid:
+                    mask[token_id] = True
+                    extensions[token_id] = (extended, extended_complete)
+            if complete or len(extensions) == 0:
+                mask[eos_token_id] = True
+            masks.append(mask)
+            if draft_token_id is None:
+                break
+            if draft_token_id == eos_token_id:
+                if mask[eos_token_id]:
+                    accepted += 1
+                break
+            if draft_token_id not in extensions:
+                break
+            accepted += 1
+            string, complete = extensions[draft_token_id]
+        return accepted, masks
+
+    def _extend_draft(self, string, token_id, decode, vocab_size, rule_name, pieces):
+        if not 0 <= token_id < vocab_size:
+            return False, string, False
+        if token_id not in pieces:
+            pieces[token_id] = decode([token_id])
+        if len(pieces[token_id]) == 0:
+            return False, string, False
+        valid, only_partially = self._check_string(string + pieces[token_id], rule_name)
+        if not valid:
+            return False, string, False
+        return True, string + pieces[token_id], not only_partially
+
+    def _check_string(self, string, rule_name):
+        success, end_position, _, error, matched_only_partially = self.parse_rule(self.rules[rule_name], string, 0)
+        if success and end_position == len(string) and error is None:
+            return True, matched_only_partially
+        return False, False
+
+    def _is_complete(self, string, rule_name):
+        if len(string) == 0:
+            return False
+        valid, only_partially = self._check_string(string, rule_name)
+        return valid and not only_partially
+
     @lru_cache(maxsize=500000)
     def parse_rule(self, rule, string, position):
-        if (rule.element_name, position) in self.memo:
-            return self.memo[(rule.element_name, position)]
         if not rule:
             return False, position, [], f"Rule '{rule.element_name}' not found"
         if self.verbose:
             print(f"Trying to parse rule '{rule.element_name}' at position {position}")
-        success, end_position, parsed_elements, error, matched_only_partially = rule.parse(string, position, self)
-        self.memo[(rule.element_name, position)] = (
-            success, end_position, parsed_elements, error, matched_only_partially)
-        return success, end_position, parsed_elements, error, matched_only_partially
+        return rule.parse(string, position, self)
 
 
 class Element: